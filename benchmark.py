@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import threading
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+from time import sleep, time
+
+import requests
+
+import snapshooter
+
+benchmark_scenarios = {
+    'baseline': {'request_names': 5, 'duration': '1h', 'interval': '10s', 'template_rows': 0},
+    'many_requests': {'request_names': 50, 'duration': '1h', 'interval': '10s', 'template_rows': 0},
+    'long_test': {'request_names': 5, 'duration': '24h', 'interval': '10s', 'template_rows': 0},
+    'fine_interval': {'request_names': 5, 'duration': '6h', 'interval': '1s', 'template_rows': 0},
+    'large_template': {'request_names': 5, 'duration': '1h', 'interval': '10s', 'template_rows': 10}
+}
+
+benchmark_params = {
+    'latency': 0.01,
+    'point_interval': '5s',
+    'repeat': 3,
+    'tolerance': 0.2,
+    'from_time': 1490958176081
+}
+
+
+class SyntheticSeries:
+    """Answer InfluxQL statements emitted by snapshooter with deterministic synthetic series of request names,
+    statuses and measurements of a Gatling test"""
+    time_range_pattern = re.compile(r'time (>=?) (\d+)ms and time < (\d+)ms')
+    group_by_time_pattern = re.compile(r'time\((\d+\w+)\)')
+    group_by_tag_pattern = re.compile(r'"(request_name|status)"')
+    request_name_pattern = re.compile(r'"request_name"\s*(=~|!=|=)\s*(?:\'([^\']*)\'|/\^\(?([^$)]*)\)?\$/)')
+    status_pattern = re.compile(r'"status"\s*(=~|=)\s*(?:\'(\w+)\'|/\^\(?([\w|]+)\)?\$/)')
+    mean_condition_pattern = re.compile(r'"mean"\s*(<=|>=|<|>)\s*(\d+)')
+    measurement_pattern = re.compile(r'FROM\s+(?:"(\w+)"|/\^\(?(\w+)|(\w+))?')
+    fields_pattern = re.compile(r'SELECT\s+(.*?)\s+FROM', re.IGNORECASE)
+    aggregate_pattern = re.compile(r'(\w+)\(')
+    where_pattern = re.compile(r'\sWHERE\s+(.*?)(?:\s+GROUP BY\s|$)')
+    where_operator_pattern = re.compile(r'\s+(?:AND|OR)\s+', re.IGNORECASE)
+    condition_pattern = re.compile(r'^(?:"\w+"|\w+)\s*(?:=~|!~|!=|<=|>=|=|<|>)\s*'
+                                   r'(?:\'[^\']*\'|/[^/]*/|-?\d+(?:\.\d+)?(?:ms)?)$')
+    conditions = {'<=': lambda a, b: a <= b, '>=': lambda a, b: a >= b, '<': lambda a, b: a < b,
+                  '>': lambda a, b: a > b}
+    statuses = ['ok', 'ko', 'all']
+    small_fields = ('count', 'active')
+
+    def __init__(self, request_names, point_interval):
+        self.request_names = ['allRequests'] + ['request_%03d' % index for index in range(request_names)]
+        self.point_interval = snapshooter.DataProvider.duration_to_ms(point_interval)
+
+    def answer(self, query):
+        """Build raw InfluxDB response for single statement, or error response if its WHERE clause is malformed"""
+        error = self.validate(query)
+        if error is not None:
+            return {'error': error}
+        if query.startswith('SHOW TAG VALUES'):
+            series = [{'name': 'fix', 'columns': ['key', 'value'],
+                       'values': [['request_name', name] for name in self.request_names]}]
+        elif query.startswith('SHOW MEASUREMENTS'):
+            series = [{'name': 'measurements', 'columns': ['name'], 'values': [['fix'], ['users']]}]
+        else:
+            series = self.select(query)
+        result = {'statement_id': 0}
+        if series:
+            result['series'] = series
+        return {'results': [result]}
+
+    def validate(self, query):
+        """Check that every condition of WHERE clause is "tag" op value or time comparison, return error message
+        of the first one that is not"""
+        where = self.where_pattern.search(query)
+        if where is None:
+            return None
+        for condition in self.where_operator_pattern.split(where.group(1).strip()):
+            if not self.condition_pattern.match(condition.strip()):
+                return 'error parsing query: invalid condition %s' % condition
+        return None
+
+    def select(self, query):
+        """Build series for SELECT statement"""
+        time_range = self.time_range_pattern.search(query)
+        lower_time, upper_time = int(time_range.group(2)), int(time_range.group(3))
+        if time_range.group(1) == '>':
+            lower_time += 1
+        measurements = [name for name in self.measurement_pattern.search(query).groups() if name]
+        measurement = measurements[0] if measurements else 'fix'
+        group_by = query.rsplit('GROUP BY', 1)[1] if 'GROUP BY' in query else ''
+        group_by_time = self.group_by_time_pattern.search(group_by)
+        group_tags = self.group_by_tag_pattern.findall(group_by)
+        fields = [field.strip().strip('"') for field in self.fields_pattern.search(query).group(1).split(',')]
+        aggregate = self.aggregate_pattern.match(fields[0])
+
+        groups = [{}]
+        for tag, values in (('request_name', self.get_request_names(query)), ('status', self.get_statuses(query))):
+            if tag in group_tags:
+                groups = [dict(group, **{tag: value}) for group in groups for value in values]
+        series = []
+        for tags in groups:
+            seed = hash((measurement, tags.get('request_name'), tags.get('status'))) % 1000
+            if group_by_time is not None:
+                step = snapshooter.DataProvider.duration_to_ms(group_by_time.group(1))
+                values = self.get_buckets(query, seed, aggregate.group(1), lower_time, upper_time, step)
+                columns = ['time', aggregate.group(1).lower()]
+            elif aggregate is not None:
+                values = [[lower_time, self.get_value(seed, aggregate.group(1), lower_time)]]
+                columns = ['time', aggregate.group(1).lower()]
+            else:
+                start = (lower_time + self.point_interval - 1) // self.point_interval * self.point_interval
+                values = [[timestamp] + [self.get_value(seed, field, timestamp) for field in fields]
+                          for timestamp in range(start, upper_time, self.point_interval)]
+                columns = ['time'] + fields
+            if values:
+                item = {'name': measurement, 'columns': columns, 'values': values}
+                if tags:
+                    item['tags'] = tags
+                series.append(item)
+        return series
+
+    def get_buckets(self, query, seed, field, lower_time, upper_time, step):
+        """Values of GROUP BY time buckets, every 17th bucket has no points and is filled as query asks"""
+        conditions = [(self.conditions[operator], float(limit))
+                      for operator, limit in self.mean_condition_pattern.findall(query)]
+        values = []
+        for timestamp in range(lower_time // step * step, upper_time, step):
+            if (timestamp // step + seed) % 17 == 0 or \
+                    not all(condition(self.get_value(seed, 'mean', timestamp), limit)
+                            for condition, limit in conditions):
+                if 'fill(null)' in query:
+                    values.append([timestamp, None])
+                continue
+            values.append([timestamp, self.get_value(seed, field, timestamp)])
+        return values
+
+    def get_value(self, seed, field, timestamp):
+        """Deterministic value of field at timestamp"""
+        value = (timestamp // 1000 * 7919 + seed * 31) % 5000
+        if field.lower() in self.small_fields:
+            value %= 50
+        return float(value)
+
+    def get_request_names(self, query):
+        """Request names selected by request_name filter of query"""
+        match = self.request_name_pattern.search(query)
+        if match is None:
+            return self.request_names
+        operator, value, pattern = match.groups()
+        if operator == '!=':
+            return [name for name in self.request_names if name != value]
+        return [value] if value is not None else pattern.split('|')
+
+    def get_statuses(self, query):
+        """Statuses selected by status filter of query"""
+        match = self.status_pattern.search(query)
+        if match is None:
+            return self.statuses
+        return [match.group(2)] if match.group(2) is not None else match.group(3).split('|')
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server keeping request statistics"""
+    daemon_threads = True
+
+    def __init__(self, handler, synthetic=None, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.synthetic = synthetic
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {'queries': 0, 'rejected_queries': 0, 'response_bytes': 0, 'snapshots': 0, 'snapshot_bytes': 0,
+                      'connections': 0}
+
+    def count(self, **increments):
+        """Add increments to statistics"""
+        with self.lock:
+            for name, increment in increments.iteritems():
+                self.stats[name] += increment
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Common parts of fake InfluxDB and Grafana handlers"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count(connections=1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        """Read plain, chunked or gzip encoded request body"""
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def respond(self, status, body=''):
+        """Send response with JSON body"""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_stats(self):
+        """Send server statistics"""
+        with self.server.lock:
+            self.respond(200, json.dumps(self.server.stats))
+
+
+class FakeInfluxDBHandler(FakeHandler):
+    """InfluxDB HTTP API stand-in answering /query with synthetic series after configured latency"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/query':
+            self.answer_query(parse_qs(url.query)['q'][0])
+        elif url.path == '/stats':
+            self.respond_stats()
+        else:
+            self.respond(204)
+
+    def do_POST(self):
+        body = self.read_body()
+        url = urlparse(self.path)
+        if url.path == '/query':
+            self.answer_query(parse_qs(url.query).get('q', parse_qs(body).get('q'))[0])
+        else:
+            self.respond(204)
+
+    def answer_query(self, query):
+        """Answer query after latency, malformed queries are rejected with 400 as InfluxDB does"""
+        sleep(self.server.latency)
+        response = self.server.synthetic.answer(query)
+        body = json.dumps(response)
+        if 'error' in response:
+            self.server.count(queries=1, rejected_queries=1, response_bytes=len(body))
+            self.respond(400, body)
+            return
+        self.server.count(queries=1, response_bytes=len(body))
+        self.respond(200, body)
+
+
+class FakeGrafanaHandler(FakeHandler):
+    """Grafana snapshot API stand-in accepting and deleting snapshots"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.respond_stats()
+        else:
+            self.respond(200, '{}')
+
+    def do_POST(self):
+        body = self.read_body()
+        json.loads(body)
+        self.server.count(snapshots=1, snapshot_bytes=len(body))
+        base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.respond(200, json.dumps({'key': 'snapshot', 'deleteKey': 'snapshot',
+                                      'url': base_url + '/dashboard/snapshot/snapshot',
+                                      'deleteUrl': base_url + '/api/snapshots-delete/snapshot'}))
+
+
+class BenchmarkRunner:
+    """Run snapshot scenarios against fake InfluxDB and Grafana servers. Servers and every snapshot run in their
+    own processes, so peak memory and timings of a run are not affected by servers or previous runs"""
+
+    def __init__(self, template_path='template.json', latency=0.01, point_interval='5s', from_time=0):
+        with open(template_path) as data_file:
+            self.template = json.load(data_file)
+        self.latency = latency
+        self.point_interval = point_interval
+        self.from_time = from_time
+
+    def run(self, scenarios, repeat=1):
+        """Run each of named scenarios repeat times, return results with median of measurements"""
+        results = {}
+        for name, scenario in sorted(scenarios.iteritems()):
+            runs = [self.run_once(scenario) for _ in range(repeat)]
+            results[name] = dict(scenario, runs=runs, **self.get_medians(runs))
+            self.print_result(name, results[name])
+        return results
+
+    def run_once(self, scenario):
+        """Create one snapshot for scenario with freshly started servers"""
+        influx = FakeServer(FakeInfluxDBHandler, SyntheticSeries(scenario['request_names'], self.point_interval),
+                            self.latency)
+        grafana = FakeServer(FakeGrafanaHandler)
+        server_processes = [self.start_server(influx), self.start_server(grafana)]
+        try:
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=self.create_snapshot,
+                                              args=(scenario, influx.server_port, grafana.server_port, result_queue))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            result.update(self.get_stats(influx.server_port))
+            result['snapshot_bytes'] = self.get_stats(grafana.server_port)['snapshot_bytes']
+            if result['error'] is None and (result.get('failed_queries') or result['rejected_queries']):
+                result['error'] = '%d queries failed, %d rejected as malformed' % (result.get('failed_queries', 0),
+                                                                                  result['rejected_queries'])
+            return result
+        finally:
+            for server_process in server_processes:
+                server_process.terminate()
+
+    @staticmethod
+    def start_server(server):
+        """Serve in child process, parent only keeps the bound port"""
+        process = multiprocessing.Process(target=server.serve_forever)
+        process.daemon = True
+        process.start()
+        server.server_close()
+        return process
+
+    @staticmethod
+    def get_stats(port):
+        """Statistics collected by fake server"""
+        return requests.get('http://127.0.0.1:%d/stats' % port).json()
+
+    def create_snapshot(self, scenario, influx_port, grafana_port, result_queue):
+        """Create snapshot in child process and put measurements to result queue"""
+        sys.stdout = open(os.devnull, 'w')
+        result = {'error': None}
+        try:
+            connection_params = dict(snapshooter.connection_params, host='127.0.0.1', port=influx_port,
+                                     grafana_url='http://127.0.0.1:%d' % grafana_port)
+            arguments_dict = dict(copy.deepcopy(snapshooter.arguments_dict), request_name=[],
+                                  interval=scenario['interval'], from_time=self.from_time,
+                                  to_time=self.from_time + snapshooter.DataProvider.duration_to_ms(scenario['duration']))
+            started = time()
+            creator = snapshooter.SnapshotCreator(connection_params, arguments_dict, snapshooter.overview_structure,
+                                                  snapshooter.separate_requests_dict,
+                                                  template=self.get_template(scenario['template_rows']),
+                                                  execution_params=snapshooter.execution_params,
+                                                  distribution_structure=snapshooter.distribution_structure,
+                                                  upload_params=snapshooter.upload_params,
+                                                  downsampling_params=snapshooter.downsampling_params,
+                                                  transport_params=snapshooter.transport_params,
+                                                  metadata_params=dict(snapshooter.metadata_params, path=None),
+                                                  active_requests_query=snapshooter.active_requests_query)
+            snapshot_started = time()
+            snapshot = creator.get_snapshot()
+            result['duration'] = time() - started
+            result['snapshot_duration'] = time() - snapshot_started
+            if snapshot is None or not snapshot.ok:
+                result['error'] = 'Snapshot was not created'
+            result['failed_queries'] = len(creator.data_provider.failed_queries)
+            result['phases'] = dict((name, phase['duration'])
+                                    for name, phase in creator.instrumentation.report()['phases'].iteritems())
+        except Exception as e:
+            result['error'] = str(e)
+        result['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result_queue.put(result)
+
+    def get_template(self, extra_rows):
+        """Dashboard template with overview row repeated extra_rows times"""
+        template = copy.deepcopy(self.template)
+        rows = template['dashboard']['rows']
+        for index in range(extra_rows):
+            row = copy.deepcopy(rows[0])
+            row['title'] = '%s %d' % (row['title'], index + 1)
+            rows.insert(1, row)
+        return template
+
+    @staticmethod
+    def get_medians(runs):
+        """Median of numeric measurements over runs"""
+        medians = {}
+        for name in ('duration', 'snapshot_duration', 'queries', 'response_bytes', 'snapshot_bytes', 'peak_memory_kb'):
+            values = sorted(run[name] for run in runs if run.get(name) is not None)
+            medians[name] = values[len(values) / 2] if values else None
+        medians['errors'] = [run['error'] for run in runs if run['error'] is not None]
+        return medians
+
+    @staticmethod
+    def print_result(name, result):
+        """Print one line summary of scenario"""
+        if result['errors']:
+            print "%-16s failed: %s" % (name, result['errors'][0])
+            return
+        print "%-16s %8.3fs %6d queries %10d response bytes %10d snapshot bytes %8d KB peak" % (
+            name, result['duration'], result['queries'], result['response_bytes'], result['snapshot_bytes'],
+            result['peak_memory_kb'])
+
+    @staticmethod
+    def compare(results, baseline, tolerance):
+        """Regressions of results against baseline results: failed runs, slower or bigger by more than tolerance,
+        or more queries"""
+        regressions = []
+        for name, result in sorted(results.iteritems()):
+            if result['errors']:
+                regressions.append("%s: %s" % (name, result['errors'][0]))
+                continue
+            if name not in baseline:
+                continue
+            for measurement, limit in (('duration', 1 + tolerance), ('peak_memory_kb', 1 + tolerance),
+                                       ('queries', 1)):
+                if result[measurement] > baseline[name][measurement] * limit:
+                    regressions.append("%s: %s %s -> %s" % (name, measurement, baseline[name][measurement],
+                                                             result[measurement]))
+        return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark snapshot creation against fake InfluxDB and Grafana')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default: %s' %
+                                                     ', '.join(sorted(benchmark_scenarios)))
+    parser.add_argument('--repeat', type=int, default=benchmark_params['repeat'])
+    parser.add_argument('--latency', type=float, default=benchmark_params['latency'],
+                        help='seconds fake InfluxDB waits before answering each query')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--baseline', help='compare with results JSON written earlier by --output')
+    parser.add_argument('--tolerance', type=float, default=benchmark_params['tolerance'])
+    options = parser.parse_args()
+
+    runner = BenchmarkRunner(latency=options.latency, point_interval=benchmark_params['point_interval'],
+                             from_time=benchmark_params['from_time'])
+    results = runner.run(dict((name, benchmark_scenarios[name]) for name in options.scenarios or benchmark_scenarios),
+                         options.repeat)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = runner.compare(results, json.load(baseline_file), options.tolerance)
+        for regression in regressions:
+            print "Regression %s" % regression
+        sys.exit(1 if regressions else 0)
+    sys.exit(1 if any(result['errors'] for result in results.itervalues()) else 0)
@@ -1,15 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import copy
+import hashlib
 import json
+import operator
+import os
+import re
+import sys
+import threading
+import zlib
+from contextlib import contextmanager
+from fractions import gcd
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
 
 from influxdb import InfluxDBClient
 
-from time import localtime, strftime
+from time import localtime, sleep, strftime, time
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 requests_query = """SHOW TAG VALUES WITH KEY = "request_name" WHERE "simulation" =~ /^%(simulation)s$/"""
+active_requests_query = """SELECT COUNT("count") FROM /.*/ WHERE "simulation" =~ /^%(simulation)s$/ AND "status" = 'all' AND %(time_filter)s GROUP BY "request_name\""""
 overview_structure = {
     "Total request count": {
         "req_count": """SELECT SUM(count) FROM /^%(test_type)s/ WHERE "request_name"= 'allRequests' AND "simulation" =~ /^%(simulation)s$/ AND "status" = 'all' %(user_count)s %(env)s AND %(time_filter)s GROUP BY count"""
@@ -67,6 +91,18 @@ separate_requests_dict = {
     }
 }
 
+distribution_structure = {
+    "Response time distribution?graph": """SELECT "count", "mean" FROM /^%(test_type)s/ WHERE "request_name" = 'allRequests' AND "simulation" =~ /^%(simulation)s$/ %(user_count)s AND "status" =~ /^(ok|ko)$/ %(env)s AND %(time_filter)s GROUP BY "status\"""",
+    "distribution": """SELECT "count", "mean" FROM /^%(test_type)s/ WHERE "request_name"=~ /^%(req_name)s$/ AND "simulation" =~ /^%(simulation)s$/ %(user_count)s AND "status" =~ /^(ok|ko)$/ %(env)s AND %(time_filter)s GROUP BY "status\""""
+}
+
+distribution_buckets = {
+    "t < %(low_limit)s ms": ('ok', [(operator.le, 'low_limit')]),
+    "%(low_limit)s < t < %(high_limit)s": ('ok', [(operator.gt, 'low_limit'), (operator.lt, 'high_limit')]),
+    "t > %(high_limit)s ms": ('ok', [(operator.ge, 'high_limit')]),
+    "failed": ('ko', [])
+}
+
 connection_params = {
     'host': '10.192.122.105',
     'port': 7777,
@@ -75,6 +111,55 @@ connection_params = {
     'database': 'perftest'
 }
 
+transport_params = {
+    'pool_size': 16,
+    'max_retries': 3,
+    'backoff_factor': 0.5,
+    'max_per_host': 8
+}
+
+snapshot_key = "Bearer eyJrIjoiQXh4eTd5eGo4cTBzNnJHYnY1NWJuaTVTd1I5eTczZE0iLCJuIjoic25hcHNob3Rfa2V5IiwiaWQiOjF9"
+
+batch_params = {
+    'max_parallel_snapshots': 4
+}
+
+execution_params = {
+    'max_in_flight': 8,
+    'query_timeout': 60,
+    'max_grouped_rows': 10000,
+    'columnar_datapoints': True,
+    'shard_duration': '6h'
+}
+
+cache_params = {
+    'path': '.snapshooter_cache',
+    'max_size': 512 * 1024 * 1024
+}
+
+metadata_params = {
+    'path': '.snapshooter_metadata.json',
+    'ttl': 60 * 60,
+    'active_requests_only': True
+}
+
+upload_params = {
+    'stream': True,
+    'gzip': False,
+    'chunk_size': 64 * 1024
+}
+
+downsampling_params = {
+    'max_datapoints': 1000,
+    'auto_interval': False
+}
+
+instrumentation_params = {
+    'report_path': None,
+    'measurement': None,
+    'profile_path': None
+}
+
 arguments_dict = {
     "calculation": ["percentiles95"],
     "interval": "10s",
@@ -91,45 +176,715 @@ arguments_dict = {
 }
 
 
+class HttpTransport:
+    """HTTP session shared by InfluxDB queries and Grafana uploads. Keeps connection pools alive between
+    requests, retries with backoff on connection errors, timeouts and 5xx responses and limits number of
+    concurrent requests to each host"""
+    retry_statuses = (500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, max_retries=3, backoff_factor=0.5, max_per_host=8):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_per_host = max_per_host
+        self.host_limits = {}
+        self.lock = threading.Lock()
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                   max_retries=Retry(total=max_retries, backoff_factor=backoff_factor,
+                                                     status_forcelist=self.retry_statuses))
+        self.session = requests.Session()
+        self.session.hooks['response'].append(self.record_response)
+        self.responses = threading.local()
+        self.mount_adapter()
+
+    def mount_adapter(self):
+        """Mount pooled adapter with retries for all hosts"""
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def record_response(self, response, *args, **kwargs):
+        """Remember body size of the last response received by current thread"""
+        if not kwargs.get('stream'):
+            self.responses.size = len(response.content)
+
+    def get_response_size(self):
+        """Body size of the last response received by current thread"""
+        return getattr(self.responses, 'size', 0)
+
+    def limit(self, host):
+        """Semaphore limiting concurrent requests to host"""
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_limits[host]
+
+    def create_influx_client(self, connection_params, timeout=None):
+        """Create InfluxDB client sending requests through shared session, retries are made by transport"""
+        client = InfluxDBClient(connection_params['host'], connection_params['port'], connection_params['login'],
+                                connection_params['password'], connection_params['database'], timeout=timeout,
+                                retries=1, pool_size=self.pool_size, session=self.session)
+        # Client mounts its own adapter to the session, transport adapter is restored to keep retries and pool
+        self.mount_adapter()
+        return client
+
+    def post(self, url, data_factory, **kwargs):
+        """Make POST request with body created by data_factory for each attempt, so streamed bodies can be
+        retried with backoff on connection errors, timeouts and 5xx responses"""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                sleep(self.backoff_factor * 2 ** (attempt - 1))
+            try:
+                with self.limit(urlparse(url).netloc):
+                    response = self.session.post(url, data=data_factory(), **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                continue
+            if response.status_code not in self.retry_statuses or attempt == self.max_retries:
+                return response
+
+    def get(self, url, **kwargs):
+        """Make GET request, retried by adapter"""
+        with self.limit(urlparse(url).netloc):
+            return self.session.get(url, **kwargs)
+
+
+class Instrumentation:
+    """Collect per-query latency, rows and response size, wall time of snapshot phases, peak memory and payload
+    size into a report which can be saved as JSON or written to InfluxDB"""
+
+    def __init__(self, report_path=None, measurement=None, profile_path=None):
+        self.report_path = report_path
+        self.measurement = measurement
+        self.profile_path = profile_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self.lock:
+            self.started = time()
+            self.queries = []
+            self.phases = {}
+            self.payload = {}
+
+    def record_query(self, query, latency, raw, response_bytes, cached=False):
+        """Record single InfluxDB query"""
+        rows = sum(len(item['values']) for item in raw.get('series', []))
+        with self.lock:
+            self.queries.append({'query': query, 'latency': latency, 'rows': rows, 'response_bytes': response_bytes,
+                                 'cached': cached})
+
+    def record_phase(self, name, duration):
+        """Add wall time of phase, phases can be recorded several times and from several threads"""
+        peak_memory = self.get_peak_memory()
+        with self.lock:
+            phase = self.phases.setdefault(name, {'duration': 0.0, 'calls': 0})
+            phase['duration'] += duration
+            phase['calls'] += 1
+            phase['peak_memory_kb'] = peak_memory
+
+    @contextmanager
+    def phase(self, name):
+        """Record wall time of the block as phase"""
+        started = time()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time() - started)
+
+    def record_payload(self, upload_stats):
+        """Record size of uploaded snapshot"""
+        self.payload = dict(upload_stats)
+
+    @staticmethod
+    def get_peak_memory():
+        """Peak resident memory of the process in kilobytes, None where it is not available"""
+        if resource is None:
+            return None
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_memory / 1024 if sys.platform == 'darwin' else peak_memory
+
+    def profile(self, func, *args):
+        """Call func under cProfile and dump stats to profile_path if it is set. Only the calling thread is
+        profiled, queries running in pool threads show up as waiting"""
+        if not self.profile_path:
+            return func(*args)
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            profiler.dump_stats(self.profile_path)
+
+    def report(self):
+        """Build report dict with summary, phases and queries ordered by latency"""
+        with self.lock:
+            queries = sorted(self.queries, key=lambda item: item['latency'], reverse=True)
+            phases = copy.deepcopy(self.phases)
+        executed = [item for item in queries if not item['cached']]
+        summary = {
+            'duration': time() - self.started,
+            'queries': len(executed),
+            'cached_queries': len(queries) - len(executed),
+            'query_latency': sum((item['latency'] for item in executed), 0.0),
+            'max_query_latency': max([item['latency'] for item in executed] or [0.0]),
+            'rows': sum(item['rows'] for item in queries),
+            'response_bytes': sum(item['response_bytes'] for item in executed),
+            'peak_memory_kb': self.get_peak_memory()
+        }
+        summary.update(self.payload)
+        return {'summary': summary, 'phases': phases, 'queries': queries}
+
+    def get_points(self, report, tags):
+        """Convert report into InfluxDB points of measurement, one per phase and one with summary"""
+        points = [{'measurement': self.measurement, 'tags': dict(tags, phase=name), 'fields': fields}
+                  for name, fields in report['phases'].iteritems()]
+        points.append({'measurement': self.measurement, 'tags': dict(tags, phase='total'),
+                       'fields': dict((name, value) for name, value in report['summary'].iteritems()
+                                      if value is not None)})
+        return points
+
+    def save(self, client, tags):
+        """Write report to report_path and to InfluxDB measurement, whichever is set"""
+        report = self.report()
+        summary = report['summary']
+        print "Instrumentation: %(queries)d queries, %(query_latency).3fs total latency, %(rows)d rows, " \
+              "%(response_bytes)d response bytes, %(duration).3fs overall" % summary
+        if self.report_path:
+            with open(self.report_path, 'w') as report_file:
+                json.dump(report, report_file, indent=4)
+        if self.measurement:
+            client.write_points(self.get_points(report, tags))
+        return report
+
+
+class QueryCache:
+    """On-disk cache of raw InfluxDB responses with LRU eviction by file access order"""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.stores = self.evictions = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum(size for _, _, size in self.get_entries())
+
+    def get(self, query, database):
+        """Return cached raw response for query or None"""
+        entry_path = self.get_entry_path(query, database)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                raw = json.loads(zlib.decompress(entry_file.read()))
+            os.utime(entry_path, None)
+        except (IOError, OSError, ValueError, zlib.error):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return raw
+
+    def put(self, query, database, raw):
+        """Store raw response for query, evict least recently used entries when cache exceeds max size"""
+        entry_path = self.get_entry_path(query, database)
+        data = zlib.compress(json.dumps(raw, separators=(',', ':')))
+        temp_path = "%s.%d.%d.tmp" % (entry_path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'wb') as entry_file:
+            entry_file.write(data)
+        with self.lock:
+            try:
+                replaced_size = os.path.getsize(entry_path)
+            except OSError:
+                replaced_size = 0
+            os.rename(temp_path, entry_path)
+            self.stores += 1
+            self.size += len(data) - replaced_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until cache fits into max size"""
+        entries = sorted(self.get_entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, entry_path, size in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def get_entries(self):
+        """List (access time, path, size) of cache entries"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                continue
+            entry_path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry_path, stat.st_size))
+        return entries
+
+    def get_entry_path(self, query, database):
+        """Build entry file path from query and database it is executed against"""
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(database + "\n" + query).hexdigest())
+
+    def get_stats(self):
+        """Return hit/miss statistics of cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions,
+                'size': self.size}
+
+
+class MetadataIndex:
+    """Results of metadata queries (tag values, measurements) by database, shared by snapshots and optionally
+    persisted to JSON file shared by runs. Entries older than ttl seconds are queried again"""
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.entries = self.load()
+
+    def load(self):
+        """Read entries persisted by previous runs, missing or broken file gives empty index"""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as index_file:
+                return json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, query, database):
+        """Return rows of metadata query or None if they are missing or expired"""
+        with self.lock:
+            entry = self.entries.get(self.get_key(query, database))
+            if entry is None or self.is_expired(entry):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry['rows']
+
+    def put(self, query, database, rows):
+        """Store rows of metadata query and persist index"""
+        with self.lock:
+            self.entries[self.get_key(query, database)] = {'time': time(), 'rows': rows}
+            self.save()
+
+    def save(self):
+        """Write index file merged with entries stored by other runs meanwhile, expired entries are dropped"""
+        if not self.path:
+            return
+        for key, entry in self.load().iteritems():
+            if key not in self.entries or self.entries[key]['time'] < entry['time']:
+                self.entries[key] = entry
+        self.entries = dict((key, entry) for key, entry in self.entries.iteritems() if not self.is_expired(entry))
+        temp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.rename(temp_path, self.path)
+
+    def is_expired(self, entry):
+        """Check that entry is older than ttl"""
+        return self.ttl is not None and time() - entry['time'] > self.ttl
+
+    @staticmethod
+    def get_key(query, database):
+        """Build entry key from query and database it is executed against"""
+        return database + "\n" + query
+
+    def get_stats(self):
+        """Return hit/miss statistics of index"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class Datapoints:
+    """Series datapoints held as int64 time and float64 value columns, null values are stored as NaN.
+    Datapoints are always exposed in Grafana [value, time] order, so no swap of stored data is needed"""
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build datapoints from InfluxDB [time, value] rows"""
+        times = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+        values = np.fromiter((np.nan if row[1] is None else row[1] for row in rows), np.float64, len(rows))
+        return cls(times, values)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for value, point_time in zip(self.values.tolist(), self.times.tolist()):
+            yield [None if value != value else value, point_time]
+
+    def iter_json(self, chunk_size=4096):
+        """Serialize datapoints to JSON array of [value, time] pairs in chunks of chunk_size points"""
+        yield "["
+        for start in range(0, len(self.times), chunk_size):
+            values = self.values[start:start + chunk_size].tolist()
+            times = self.times[start:start + chunk_size].tolist()
+            yield ("," if start else "") + ",".join(
+                ["[null,%d]" % point_time if value != value else "[%r,%d]" % (value, point_time)
+                 for value, point_time in zip(values, times)])
+        yield "]"
+
+
 class DataProvider:
-    def __init__(self, connection_params, arguments_dict):
+    group_by_time_pattern = re.compile(r'GROUP BY time\(((?:%\(\w+\)s|\w)+)\)')
+    time_upper_bound_pattern = re.compile(r'time < (\d+)ms')
+    time_range_pattern = re.compile(r'time >=? (\d+)ms and time < (\d+)ms')
+    aggregate_pattern = re.compile(r'SELECT\s+(\w+)\(', re.IGNORECASE)
+    shard_combiners = {'SUM': sum, 'COUNT': sum, 'MIN': min, 'MAX': max}
+    request_name_filter_pattern = re.compile(r'"request_name"\s*=~\s*/\^%\(req_name\)s\$/')
+    duration_units = {'ms': 1, 's': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000,
+                      'w': 7 * 24 * 60 * 60 * 1000}
+
+    def __init__(self, connection_params, arguments_dict, execution_params=None, query_cache=None,
+                 distribution_structure=None, client=None, metadata_index=None, transport=None, instrumentation=None):
         self.arguments_dict = arguments_dict
-        self.client = InfluxDBClient(connection_params['host'], connection_params['port'], connection_params['login'],
-                                     connection_params['password'], connection_params['database'])
+        self.transport = transport or HttpTransport()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.influx_host = "%(host)s:%(port)s" % connection_params
+        self.query_cache = query_cache
+        self.metadata_index = metadata_index or MetadataIndex()
+        self.distribution_structure = distribution_structure or {}
+        self.database = "%(host)s:%(port)s/%(database)s" % connection_params
+        execution_params = execution_params or {}
+        self.max_in_flight = execution_params.get('max_in_flight', 1)
+        self.query_timeout = execution_params.get('query_timeout')
+        self.max_grouped_rows = execution_params.get('max_grouped_rows', 0)
+        self.columnar = np is not None and execution_params.get('columnar_datapoints', False)
+        self.shard_duration = execution_params.get('shard_duration')
+        self.in_flight = threading.BoundedSemaphore(max(1, self.max_in_flight))
+        self.failed_queries = []
+        self.client = client or self.transport.create_influx_client(connection_params, self.query_timeout)
 
     def get_overview_data(self, dashboard_requests_dict, query_values_dict):
         """Collect test data for overall dashboards"""
         results_dict = {}
+        jobs = []
         for name, value in dashboard_requests_dict.iteritems():
             formatted_name = name % query_values_dict
             results_dict[formatted_name] = {}
+            value = self.add_distribution_job(jobs, name, value, query_values_dict, results_dict[formatted_name])
             for k, v in value.iteritems():
-                results_dict[formatted_name][k % query_values_dict] = self.get_influx_data(v % query_values_dict)
+                jobs.append((self.get_influx_data, v % query_values_dict,
+                             [(results_dict[formatted_name], k % query_values_dict, None)]))
+        self.fill_results(jobs)
         return results_dict
 
-    def get_requests_data(self, separate_requests_dict, query_values_dict):
-        """Collect test data for separate requests dashboards"""
-        separate_results_dict = {}
-        for name in self.arguments_dict['request_names']:
-            separate_results_dict[name] = {}
-            for k, v in separate_requests_dict.iteritems():
-                separate_results_dict[name][k] = {}
-                for query_key, query_value in v.iteritems():
-                    query_values_dict['req_name'] = name
-                    result = self.get_influx_data(query_value % query_values_dict)
-                    separate_results_dict[name][k][query_key % query_values_dict] = result
+    def get_requests_data(self, separate_requests_dict, query_values_dict, request_names=None):
+        """Collect test data for separate requests dashboards of request_names, all requests by default"""
+        if request_names is None:
+            request_names = self.arguments_dict['request_names']
+        if not request_names:
+            return {}
+        separate_results_dict = dict((name, dict((k, {}) for k in separate_requests_dict)) for name in request_names)
+        jobs = []
+        for k, v in separate_requests_dict.iteritems():
+            remaining_queries = v
+            for name in request_names:
+                request_values_dict = dict(query_values_dict, req_name=name)
+                remaining_queries = self.add_distribution_job(jobs, k, v, request_values_dict,
+                                                              separate_results_dict[name][k])
+            for query_key, query_value in remaining_queries.iteritems():
+                targets = [(separate_results_dict[name][k], query_key % dict(query_values_dict, req_name=name), name)
+                           for name in request_names]
+                if '%(req_name)s' not in query_value:
+                    jobs.append((self.get_influx_data, query_value % query_values_dict,
+                                 [(target, key, None) for target, key, _ in targets]))
+                    continue
+                for batch in self.plan_request_batches(query_value, query_values_dict, request_names):
+                    batch_targets = [target for target in targets if target[2] in batch]
+                    if len(batch) == 1:
+                        jobs.append((self.get_influx_data, query_value % dict(query_values_dict, req_name=batch[0]),
+                                     [(target, key, None) for target, key, _ in batch_targets]))
+                    else:
+                        jobs.append((self.get_influx_series, self.group_by_request_name(query_value) % dict(
+                            query_values_dict, req_names="|".join(batch)), batch_targets))
+        self.fill_results(jobs)
         return separate_results_dict
 
+    def add_distribution_job(self, jobs, name, queries, query_values_dict, target):
+        """Add job computing response time distribution buckets locally from raw points, if it is enabled for
+        dashboard name. Returns queries that still have to be executed"""
+        if np is None or name not in self.distribution_structure:
+            return queries
+        bucket_targets = [(target, key % query_values_dict, key) for key in queries if key in distribution_buckets]
+        jobs.append((self.get_distribution_data, self.distribution_structure[name] % query_values_dict,
+                     bucket_targets))
+        return dict((key, query) for key, query in queries.iteritems() if key not in distribution_buckets)
+
+    def plan_request_batches(self, query_template, query_values_dict, request_names):
+        """Split request names into batches that can be queried at once with GROUP BY "request_name".
+        Batches are limited by max_grouped_rows, single name batches use the per-request query"""
+        if not request_names:
+            return []
+        rows_per_request = self.estimate_rows(query_template % dict(query_values_dict, req_name=request_names[0]))
+        if not self.max_grouped_rows or rows_per_request is None \
+                or self.group_by_request_name(query_template) is None:
+            return [[name] for name in request_names]
+        batch_size = max(1, self.max_grouped_rows / rows_per_request)
+        return [request_names[i:i + batch_size] for i in range(0, len(request_names), batch_size)]
+
+    def estimate_rows(self, query):
+        """Estimate number of points returned for single series by GROUP BY time query"""
+        group_by_time = self.group_by_time_pattern.search(query)
+        if group_by_time is None:
+            return None
+        step = self.duration_to_ms(group_by_time.group(1))
+        return (self.arguments_dict['to_time'] - self.arguments_dict['from_time']) / step + 1
+
+    def group_by_request_name(self, query_template):
+        """Rewrite per-request query template into query for several requests grouped by request name"""
+        if not self.request_name_filter_pattern.search(query_template) \
+                or not self.group_by_time_pattern.search(query_template):
+            return None
+        query_template = self.request_name_filter_pattern.sub('"request_name" =~ /^(%(req_names)s)$/',
+                                                              query_template)
+        return self.group_by_time_pattern.sub(r'GROUP BY time(\1), "request_name"', query_template)
+
+    @staticmethod
+    def duration_to_ms(duration):
+        """Convert InfluxDB duration literal like 10s or 1m to milliseconds"""
+        value, unit = re.match(r'(\d+)(\w+)$', duration).groups()
+        return int(value) * DataProvider.duration_units[unit]
+
+    def fill_results(self, jobs):
+        """Execute (method, query, [(target dict, result key, result selector)]) jobs and store results into
+        target dicts. Selector picks single series from methods returning several of them"""
+        results = self.execute_queries([(method, query) for method, query, _ in jobs])
+        for (_, _, targets), result in zip(jobs, results):
+            for target, key, selector in targets:
+                target[key] = result if selector is None else (result or {}).get(selector, [])
+
+    def execute_queries(self, calls):
+        """Run (method, query) calls with at most max_in_flight requests in flight, keeping results in the order
+        of calls. Failed queries are recorded in failed_queries and produce empty results"""
+        if self.max_in_flight <= 1 or len(calls) <= 1:
+            return [self.run_query(method, query) for method, query in calls]
+
+        pool = ThreadPool(min(self.max_in_flight, len(calls)))
+        try:
+            pending = [pool.apply_async(self.run_query, call) for call in calls]
+            # Every request is bound by the client timeout and the retries of transport, and run_query records
+            # timed out queries as failed, so results are awaited without a timeout of their own
+            return [result.get() for result in pending]
+        finally:
+            pool.terminate()
+
+    def run_query(self, method, query):
+        """Run single query, record failure instead of raising to keep results of other queries"""
+        try:
+            return method(query)
+        except Exception as e:
+            self.failed_queries.append((query, str(e)))
+            return []
+
     def get_influx_data(self, query, swap=True, index=0):
         """Make provided request to InfluxDB and swap datapoints for sending to Grafana"""
-        resp = self.client.query(query, epoch='ms')
+        raw = self.get_raw_data(query)
         values = []
-        if 'series' in resp.raw:
-            values = resp.raw['series'][index]['values']
+        if 'series' in raw:
+            values = raw['series'][index]['values']
             if swap:
-                return self.swap_datapoints(values)
+                return self.to_datapoints(values)
         return values
 
+    def get_metadata(self, query):
+        """Make provided metadata request (SHOW ...) to InfluxDB, results are shared by all users of metadata index"""
+        rows = self.metadata_index.get(query, self.database)
+        if rows is None:
+            rows = self.get_influx_data(query, False)
+            self.metadata_index.put(query, self.database, rows)
+        return rows
+
+    def get_active_tag_values(self, query, tag='request_name'):
+        """Make provided request grouped by tag and return values of tag having series in the result,
+        results are shared by all users of metadata index"""
+        tag_values = self.metadata_index.get(query, self.database)
+        if tag_values is None:
+            tag_values = sorted(value for value in self.get_influx_series(query, tag) if value is not None)
+            self.metadata_index.put(query, self.database, tag_values)
+        return tag_values
+
+    def get_influx_series(self, query, tag='request_name'):
+        """Make provided request to InfluxDB and return swapped datapoints of each series by value of tag.
+        As for single series queries only first series is taken when several measurements match"""
+        series = {}
+        for item in self.get_raw_data(query).get('series', []):
+            tag_value = item.get('tags', {}).get(tag)
+            if tag_value not in series:
+                series[tag_value] = self.to_datapoints(item['values'])
+        return series
+
+    def get_distribution_data(self, query):
+        """Make provided request for raw count and mean values grouped by status and sum counts into
+        distribution_buckets per GROUP BY time(interval) bucket, as fill(null) SUM queries would do"""
+        raw_series = self.get_raw_data(query).get('series', [])
+        with self.instrumentation.phase('distribution_buckets'):
+            columns = {}
+            for item in raw_series:
+                if item['name'] != raw_series[0]['name']:
+                    continue
+                values = np.array(item['values'], dtype=np.float64).reshape(-1, len(item['columns']))
+                columns[item['tags']['status']] = dict((column, values[:, index])
+                                                       for index, column in enumerate(item['columns']))
+
+            lower_time, upper_time = [int(bound) for bound in self.time_range_pattern.search(query).groups()]
+            step = self.duration_to_ms(self.arguments_dict['interval'])
+            start = lower_time // step * step
+            bucket_count = (upper_time - 1 - start) // step + 1
+            bucket_times = start + np.arange(bucket_count, dtype=np.int64) * step
+
+            results = {}
+            for key, (status, conditions) in distribution_buckets.iteritems():
+                if status not in columns:
+                    results[key] = []
+                    continue
+                mask = ~np.isnan(columns[status]['count'])
+                for condition, limit_name in conditions:
+                    mask &= condition(columns[status]['mean'], float(self.arguments_dict[limit_name]))
+                indexes = ((columns[status]['time'][mask] - start) // step).astype(np.int64)
+                sums = np.bincount(indexes, weights=columns[status]['count'][mask], minlength=bucket_count)
+                filled = np.bincount(indexes, minlength=bucket_count) > 0
+                sums[~filled] = np.nan
+                results[key] = Datapoints(bucket_times, sums) if self.columnar else \
+                    [[None if value != value else value, bucket_time] for value, bucket_time in
+                     zip(sums.tolist(), bucket_times.tolist())]
+            return results
+
+    def get_raw_data(self, query):
+        """Make provided request to InfluxDB and return raw response.
+        Time ranges longer than shard_duration are queried in shards when their results can be combined exactly"""
+        shard_plan = self.plan_shards(query)
+        if shard_plan is None:
+            return self.get_shard_data(query)
+        shard_queries, combiner = shard_plan
+        if self.max_in_flight <= 1:
+            shard_results = [self.get_shard_data(shard_query) for shard_query in shard_queries]
+        else:
+            pool = ThreadPool(min(self.max_in_flight, len(shard_queries)))
+            try:
+                shard_results = pool.map(self.get_shard_data, shard_queries)
+            finally:
+                pool.terminate()
+        with self.instrumentation.phase('merge_shards'):
+            return self.merge_shards(shard_results, combiner)
+
+    def get_shard_data(self, query):
+        """Make provided request to InfluxDB and return raw response.
+        Responses for time ranges that are already closed are taken from query cache when it is set"""
+        if self.query_cache is None or not self.is_closed_range(query):
+            return self.query_influx(query)
+        started = time()
+        raw = self.query_cache.get(query, self.database)
+        if raw is None:
+            raw = self.query_influx(query)
+            if 'error' not in raw:
+                self.query_cache.put(query, self.database, raw)
+        else:
+            self.instrumentation.record_query(query, time() - started, raw, 0, cached=True)
+        return raw
+
+    def query_influx(self, query):
+        """Make provided request to InfluxDB keeping at most max_in_flight requests at once, latency is
+        recorded without time spent waiting for a free slot"""
+        with self.in_flight, self.transport.limit(self.influx_host):
+            started = time()
+            raw = self.client.query(query, epoch='ms').raw
+            self.instrumentation.record_query(query, time() - started, raw, self.transport.get_response_size())
+            return raw
+
+    def plan_shards(self, query):
+        """Split query time range into shards of shard_duration aligned to GROUP BY time buckets.
+        Returns shard queries and combiner for aggregated values, or None if query should not be sharded.
+        Combiner is None when series of shards are concatenated"""
+        time_range = self.time_range_pattern.search(query)
+        if not self.shard_duration or time_range is None:
+            return None
+        lower_time, upper_time = [int(bound) for bound in time_range.groups()]
+        shard_size = self.duration_to_ms(self.shard_duration)
+
+        combiner = None
+        group_by_time = self.group_by_time_pattern.search(query)
+        aggregate = self.aggregate_pattern.match(query)
+        if group_by_time is not None:
+            step = self.duration_to_ms(group_by_time.group(1))
+            shard_size = (shard_size + step - 1) // step * step
+        elif aggregate is not None:
+            combiner = self.shard_combiners.get(aggregate.group(1).upper())
+            if combiner is None:
+                return None
+        # Checked after rounding to GROUP BY step, so there is at least one shard boundary inside time range
+        if upper_time - lower_time <= shard_size:
+            return None
+
+        boundaries = range((lower_time // shard_size + 1) * shard_size, upper_time, shard_size)
+        shard_filters = [time_range.group(0).replace("time < %dms" % upper_time, "time < %dms" % boundaries[0])]
+        shard_filters += ["time >= %dms and time < %dms" % (start, end)
+                          for start, end in zip(boundaries, boundaries[1:] + [upper_time])]
+        return [query.replace(time_range.group(0), shard_filter) for shard_filter in shard_filters], combiner
+
+    @staticmethod
+    def merge_shards(shard_results, combiner):
+        """Merge raw responses of shards into single response. Series are matched by name and tags,
+        points are concatenated in time order or their values are combined with combiner"""
+        for raw in shard_results:
+            if 'error' in raw:
+                return raw
+        merged = {}
+        for raw in shard_results:
+            for item in raw.get('series', []):
+                series_key = (item['name'], tuple(sorted(item.get('tags', {}).items())))
+                if series_key not in merged:
+                    merged[series_key] = dict(item, values=list(item['values']))
+                    continue
+                values = merged[series_key]['values']
+                if combiner is not None:
+                    values[0] = DataProvider.combine_rows(combiner, values[0], item['values'][0])
+                else:
+                    last_time = values[-1][0] if values else None
+                    values.extend(point for point in item['values'] if last_time is None or point[0] > last_time)
+        result = dict(shard_results[0])
+        if merged:
+            result['series'] = [merged[series_key] for series_key in sorted(merged)]
+        return result
+
+    @staticmethod
+    def combine_rows(combiner, row, other_row):
+        """Combine aggregated values of single row results of two shards ignoring null values"""
+        combined = row[:1]
+        for value, other_value in zip(row[1:], other_row[1:]):
+            present = [item for item in (value, other_value) if item is not None]
+            combined.append(combiner(present) if present else None)
+        return combined
+
+    def is_closed_range(self, query):
+        """Check that query is restricted by time range which ends in the past, so its result can not change"""
+        upper_bounds = [int(bound) for bound in self.time_upper_bound_pattern.findall(query)]
+        return len(upper_bounds) > 0 and max(upper_bounds) < time() * 1000
+
+    def to_datapoints(self, series_data):
+        """Convert InfluxDB [time, value] rows to datapoints in Grafana [value, time] order"""
+        with self.instrumentation.phase('to_datapoints'):
+            if self.columnar and all(len(row) == 2 for row in series_data):
+                return Datapoints.from_rows(series_data)
+            return self.swap_datapoints(series_data)
+
     @staticmethod
     def swap_datapoints(series_data):
         """Swap datapoints in provided datapoints array"""
@@ -139,8 +894,9 @@ class DataProvider:
 
 
 class ArgumentsPreprocessor:
-    def __init__(self, data_provider, arguments_dict, requests_query):
+    def __init__(self, data_provider, arguments_dict, requests_query, active_requests_query=None):
         self.requests_query = requests_query
+        self.active_requests_query = active_requests_query
         self.arguments_dict = arguments_dict
         self.data_provider = data_provider
 
@@ -159,14 +915,19 @@ class ArgumentsPreprocessor:
         return dataset
 
     def process_requests(self, dataset):
-        """Retrieve endpoints for detailed dashboards"""
+        """Retrieve endpoints for detailed dashboards, only ones having data in test time range if active requests
+        query is set"""
         if "request_name" not in dataset \
                 or (isinstance(dataset['request_name'], str) and (dataset['request_name'].lower() == "all")) \
                 or isinstance(dataset['request_name'], list) and len(dataset['request_name']) == 0:
             dataset['request_name'] = "All"
-            dataset['request_names'] = [item[0] for item in
-                                        self.data_provider.get_influx_data(self.requests_query % self.arguments_dict)
-                                        if item[0] != "allRequests"]
+            if self.active_requests_query is not None:
+                request_names = self.data_provider.get_active_tag_values(self.active_requests_query %
+                                                                         self.arguments_dict)
+            else:
+                request_names = [item[1] for item in
+                                 self.data_provider.get_metadata(self.requests_query % self.arguments_dict)]
+            dataset['request_names'] = [name for name in request_names if name != "allRequests"]
         else:
             dataset['request_names'] = dataset['request_name'] if isinstance(dataset['request_name'], list) \
                 else [dataset['request_name']]
@@ -209,24 +970,228 @@ class ArgumentsPreprocessor:
             arguments_dict['test_perc_name'] = arguments_dict['test_type']
 
 
+class Downsampler:
+    """Reduce series to point budget keeping minimum and maximum point of each time bucket,
+    so peaks and drops stay visible on graphs"""
+    nice_intervals = ['1s', '2s', '5s', '10s', '15s', '30s', '1m', '2m', '5m', '10m', '15m', '30m', '1h', '2h', '3h',
+                      '6h', '12h', '1d']
+
+    @staticmethod
+    def downsample(datapoints, budget):
+        """Return datapoints reduced to at most budget points"""
+        if not budget or len(datapoints) <= budget:
+            return datapoints
+        if isinstance(datapoints, Datapoints):
+            indexes = Downsampler.min_max_indexes(datapoints.values, budget)
+            return Datapoints(datapoints.times[indexes], datapoints.values[indexes])
+        indexes = Downsampler.list_min_max_indexes([point[0] for point in datapoints], budget)
+        return [datapoints[index] for index in indexes]
+
+    @staticmethod
+    def downsample_aligned(series, budget):
+        """Return dict of series reduced to at most budget points on time buckets shared by all series, keeping
+        maximum of each bucket, so bars and stacks of different series stay aligned"""
+        if not budget or all(len(datapoints) <= budget for datapoints in series.itervalues()):
+            return series
+        bounds = [(datapoints.times[0], datapoints.times[-1]) if isinstance(datapoints, Datapoints) else
+                  (datapoints[0][1], datapoints[-1][1]) for datapoints in series.itervalues() if len(datapoints)]
+        start = min(first for first, _ in bounds)
+        width = (max(last for _, last in bounds) - start) // budget + 1
+        return dict((target, Downsampler.bucket_max(datapoints, start, width))
+                    for target, datapoints in series.iteritems())
+
+    @staticmethod
+    def bucket_max(datapoints, start, width):
+        """Maximum of datapoints in each time bucket of width starting at start, null if bucket has only nulls.
+        Buckets without points are left out"""
+        if isinstance(datapoints, Datapoints):
+            if not len(datapoints):
+                return datapoints
+            buckets, firsts = np.unique((datapoints.times - start) // width, return_index=True)
+            return Datapoints(start + buckets * width, np.fmax.reduceat(datapoints.values, firsts))
+        reduced = []
+        for value, point_time in datapoints:
+            bucket_time = start + (point_time - start) // width * width
+            if not reduced or reduced[-1][1] != bucket_time:
+                reduced.append([value, bucket_time])
+            elif value is not None and (reduced[-1][0] is None or value > reduced[-1][0]):
+                reduced[-1][0] = value
+        return reduced
+
+    @staticmethod
+    def min_max_indexes(values, budget):
+        """Indexes of minimum and maximum of each of budget / 2 equal buckets, in time order.
+        Bucket without values keeps its first (null) point"""
+        bucket_size = -(-len(values) // max(1, budget // 2))
+        bucket_count = -(-len(values) // bucket_size)
+        padded = np.full(bucket_count * bucket_size, np.nan)
+        padded[:len(values)] = values
+        buckets = padded.reshape(bucket_count, bucket_size)
+        offsets = np.arange(bucket_count) * bucket_size
+        minimums = offsets + np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+        maximums = offsets + np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+        indexes = np.union1d(minimums, maximums)
+        return indexes[indexes < len(values)]
+
+    @staticmethod
+    def list_min_max_indexes(values, budget):
+        """Same as min_max_indexes for list of values with None for null"""
+        bucket_size = -(-len(values) // max(1, budget // 2))
+        indexes = set()
+        for start in range(0, len(values), bucket_size):
+            bucket = [index for index in range(start, min(start + bucket_size, len(values)))
+                      if values[index] is not None] or [start]
+            indexes.add(min(bucket, key=lambda index: values[index]))
+            indexes.add(max(bucket, key=lambda index: values[index]))
+        return sorted(indexes)
+
+    @staticmethod
+    def choose_interval(interval, from_time, to_time, budget):
+        """Choose GROUP BY time interval, coarser than provided one if needed to fit time range into budget"""
+        needed = (to_time - from_time) / float(budget)
+        if DataProvider.duration_to_ms(interval) >= needed:
+            return interval
+        for nice_interval in Downsampler.nice_intervals:
+            if DataProvider.duration_to_ms(nice_interval) >= needed:
+                return nice_interval
+        return "%dm" % -(-needed // DataProvider.duration_units['m'])
+
+
+class DashboardSerializer:
+    """Serialize dashboard to compact JSON, writing Datapoints columns directly without building
+    intermediate lists of points"""
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    @staticmethod
+    def dumps(dashboard):
+        return "".join(DashboardSerializer.iter_json(dashboard))
+
+    @staticmethod
+    def iter_json(item):
+        """Generate JSON chunks for item"""
+        if isinstance(item, Datapoints):
+            for chunk in item.iter_json():
+                yield chunk
+        elif isinstance(item, dict):
+            yield "{"
+            for index, (key, value) in enumerate(item.iteritems()):
+                yield ("," if index else "") + DashboardSerializer.encoder.encode(key) + ":"
+                for chunk in DashboardSerializer.iter_json(value):
+                    yield chunk
+            yield "}"
+        elif isinstance(item, list) and any(isinstance(element, (dict, Datapoints)) for element in item):
+            yield "["
+            for index, element in enumerate(item):
+                if index:
+                    yield ","
+                for chunk in DashboardSerializer.iter_json(element):
+                    yield chunk
+            yield "]"
+        else:
+            yield DashboardSerializer.encoder.encode(item)
+
+
+class SnapshotBody:
+    """Request body streaming serialized dashboard in chunks of about chunk_size bytes, optionally gzip
+    compressed. Counts serialized and sent bytes while it is consumed"""
+
+    def __init__(self, dashboard, chunk_size, compress):
+        self.dashboard = dashboard
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.serialized_bytes = 0
+        self.sent_bytes = 0
+
+    def __iter__(self):
+        self.serialized_bytes = 0
+        self.sent_bytes = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if self.compress else None
+        buffered = []
+        buffered_size = 0
+        for chunk in DashboardSerializer.iter_json(self.dashboard):
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size >= self.chunk_size:
+                data = self.encode("".join(buffered), compressor)
+                buffered = []
+                buffered_size = 0
+                if data:
+                    yield data
+        data = self.encode("".join(buffered), compressor)
+        if compressor is not None:
+            tail = compressor.flush()
+            self.sent_bytes += len(tail)
+            data += tail
+        if data:
+            yield data
+
+    def read(self):
+        """Return whole body at once for non-streaming upload"""
+        return "".join(self)
+
+    def encode(self, data, compressor):
+        """Count and compress serialized chunk"""
+        self.serialized_bytes += len(data)
+        if compressor is not None:
+            data = compressor.compress(data)
+        self.sent_bytes += len(data)
+        return data
+
+
 class SnapshotCreator:
     id_tracker = 0
     time_filter = "time > {:d}ms and time < {:d}ms"
+    tail_time_filter = "time >= {:d}ms and time < {:d}ms"
+    detailed_panels = {
+        "$request_name response times over time ($req_status)": "response times",
+        "$request_name throughput": "throughput",
+        "$request_name response times distribution": "distribution"
+    }
 
     def __init__(self, connection_params, arguments_dict, overview_structure, separate_requests_structure,
                  requests_query='SHOW TAG VALUES WITH KEY = "request_name" WHERE "simulation" =~ /^%(simulation)s$/',
-                 measurements_query="SHOW MEASUREMENTS", template_path="template.json"):
+                 measurements_query="SHOW MEASUREMENTS", template_path="template.json", execution_params=None,
+                 cache_params=None, distribution_structure=None, upload_params=None, downsampling_params=None,
+                 template=None, client=None, query_cache=None, metadata_index=None, transport_params=None,
+                 transport=None, instrumentation_params=None, metadata_params=None,
+                 active_requests_query='SELECT COUNT("count") FROM /.*/ WHERE "simulation" =~ /^%(simulation)s$/ '
+                                       'AND "status" = \'all\' AND %(time_filter)s GROUP BY "request_name"'):
+        self.instrumentation = Instrumentation(**(instrumentation_params or {}))
+        started = time()
         arguments_dict['time_filter'] = self.time_filter.format(arguments_dict['from_time'], arguments_dict['to_time'])
+        self.downsampling_params = downsampling_params or {}
+        if self.downsampling_params.get('auto_interval') and self.downsampling_params.get('max_datapoints'):
+            arguments_dict['interval'] = Downsampler.choose_interval(arguments_dict['interval'],
+                                                                     arguments_dict['from_time'],
+                                                                     arguments_dict['to_time'],
+                                                                     self.downsampling_params['max_datapoints'])
         self.measurements_query = measurements_query
         self.overview_queries = overview_structure
         self.detailed_queries = separate_requests_structure
         self.connection_params = connection_params
-        self.dashboard_template = self.get_dashboard_template(template_path)
+        self.grafana_url = connection_params.get('grafana_url', 'http://%s' % connection_params['host'])
+        self.upload_params = upload_params or {}
+        self.upload_stats = {}
+        self.transport = transport or HttpTransport(**(transport_params or {}))
+        self.overview_data = None
+        self.separate_requests_data = None
+        self.last_seen = {}
+        self.snapshot = None
+        self.dashboard_template = self.get_dashboard_template(template_path, template)
         self.insert_timerange(self.dashboard_template, arguments_dict['from_time'],
                               arguments_dict['to_time'])
         self.detailed_data_dashboard = self.get_detailed_template(self.dashboard_template)
-        self.data_provider = DataProvider(connection_params, arguments_dict)
-        self.preprocessor = ArgumentsPreprocessor(self.data_provider, arguments_dict, requests_query)
+        if query_cache is None and cache_params:
+            query_cache = QueryCache(cache_params['path'], cache_params['max_size'])
+        metadata_params = metadata_params or {}
+        if metadata_index is None:
+            metadata_index = MetadataIndex(metadata_params.get('path'), metadata_params.get('ttl'))
+        self.data_provider = DataProvider(connection_params, arguments_dict, execution_params, query_cache,
+                                          distribution_structure, client, metadata_index, self.transport,
+                                          self.instrumentation)
+        self.preprocessor = ArgumentsPreprocessor(self.data_provider, arguments_dict, requests_query,
+                                                  active_requests_query if metadata_params.get('active_requests_only')
+                                                  else None)
         self.query_values_dict = dict(self.get_dashboard_keys(self.dashboard_template),
                                       **self.preprocessor.process_dataset(arguments_dict))
         self.replace_keys(self.dashboard_template, self.query_values_dict)
@@ -234,6 +1199,8 @@ class SnapshotCreator:
         self.preprocessor.process_multiple_or_empty('test_type', self.query_values_dict)
         self.preprocessor.process_multiple_or_empty('user_count', self.query_values_dict)
         self.preprocessor.process_multiple_or_empty('env', self.query_values_dict)
+        self.compile_template()
+        self.instrumentation.record_phase('prepare', time() - started)
 
     def inc_and_get(self):
         """Inrement and get value for dashboard id"""
@@ -292,7 +1259,7 @@ class SnapshotCreator:
                 if name == "All" or name == ".*":
                     if template_key == "test_type":
                         template_value = [item[0] for item in
-                                          self.data_provider.get_influx_data(self.measurements_query, False)]
+                                          self.data_provider.get_metadata(self.measurements_query)]
                     else:
                         name = "All"
                         template_value = ["$__all"]
@@ -305,77 +1272,284 @@ class SnapshotCreator:
 
                 key["options"] = [key['current']]
 
+    def compile_template(self):
+        """Render alias color rules once and index overview panels by title and by (title, type)"""
+        self.panel_index = {}
+        for row in self.dashboard_template['dashboard']['rows']:
+            for panel in row['panels']:
+                if 'aliasColors' in panel:
+                    self.replace_color_rules(panel)
+                self.panel_index.setdefault((panel['title'], None), []).append(panel)
+                self.panel_index.setdefault((panel['title'], panel['type']), []).append(panel)
+        for panel in self.detailed_data_dashboard['panels']:
+            if 'aliasColors' in panel:
+                self.replace_color_rules(panel)
+        self.detailed_rows_start = len(self.dashboard_template['dashboard']['rows'])
+
+    def clone_detailed_row(self, request_name):
+        """Clone detailed row for request, copying only fields that differ between requests"""
+        row = dict(self.detailed_data_dashboard)
+        row['title'] = row['title'].replace("$request_name", request_name)
+        row['panels'] = []
+        for template_panel in self.detailed_data_dashboard['panels']:
+            panel = dict(template_panel)
+            panel['title'] = panel['title'].replace("$request_name", request_name)
+            panel['id'] = self.inc_and_get()
+            panel['scopedVars'] = dict(panel['scopedVars'])
+            panel['scopedVars']['request_name'] = dict(panel['scopedVars']['request_name'], text=request_name,
+                                                       value=request_name)
+            row['panels'].append(panel)
+        return row
+
     def insert_separate_dashboards(self, dataset):
         """Insert dashboards with detailed data for each separate request"""
         for result_key, result_value in dataset.iteritems():
-            detailed_data_template = copy.deepcopy(self.detailed_data_dashboard)
-            detailed_data_template['title'] = detailed_data_template['title'].replace("$request_name", result_key)
-
-            for panel in detailed_data_template["panels"]:
-                if 'aliasColors' in panel:
-                    self.replace_color_rules(panel)
-                panel['title'] = panel['title'].replace("$request_name", result_key)
-                panel['id'] = self.inc_and_get()
-                panel['scopedVars']['request_name']['text'] = result_key
-                panel['scopedVars']['request_name']['value'] = result_key
-
-                if ("%s response times over time ($req_status)" % result_key) == panel['title']:
-                    panel['snapshotData'] = []
-                    for k, v in result_value["response times"].iteritems():
-                        panel['snapshotData'].append({"datapoints": v, "target": k})
-
-                if ("%s throughput" % result_key) == panel['title']:
-                    panel['snapshotData'] = []
-                    for k, v in result_value["throughput"].iteritems():
-                        panel['snapshotData'].append({"datapoints": v, "target": k})
-
-                if ("%s response times distribution" % result_key) == panel['title']:
-                    panel['snapshotData'] = []
-                    for k, v in result_value["distribution"].iteritems():
-                        panel['snapshotData'].append({"datapoints": v, "target": k})
+            detailed_data_template = self.clone_detailed_row(result_key)
+            for template_panel, panel in zip(self.detailed_data_dashboard['panels'],
+                                             detailed_data_template['panels']):
+                data_key = self.detailed_panels.get(template_panel['title'])
+                if data_key is not None:
+                    panel['snapshotData'] = self.get_snapshot_data(result_value[data_key], panel)
             self.dashboard_template['dashboard']['rows'].append(detailed_data_template)
 
     def insert_dataset(self, dataset):
         """Insert data into overview dashboards, also insert current dashboard id"""
         for k, v in dataset.iteritems():
             dashboard_pointers = k.split("?")
-            for row in self.dashboard_template['dashboard']['rows']:
-                for panel in row['panels']:
-                    if 'aliasColors' in panel:
-                        self.replace_color_rules(panel)
-                    if panel['title'] == dashboard_pointers[0]:
-                        if (len(dashboard_pointers) > 1 and dashboard_pointers[1] == panel["type"]) or (
-                                    len(dashboard_pointers) == 1):
-                            panel['snapshotData'] = []
-                            for request, datapoints in v.iteritems():
-                                panel['snapshotData'].append({"datapoints": datapoints, "target": request})
-
-    def get_snapshot(self,
-                     key="Bearer eyJrIjoiQXh4eTd5eGo4cTBzNnJHYnY1NWJuaTVTd1I5eTczZE0iLCJuIjoic25hcHNob3Rfa2V5IiwiaWQiOjF9"):
-        """Insert data to dashboards and make snapshot request"""
+            panel_type = dashboard_pointers[1] if len(dashboard_pointers) > 1 else None
+            for panel in self.panel_index.get((dashboard_pointers[0], panel_type), []):
+                panel['snapshotData'] = self.get_snapshot_data(v, panel)
+
+    def get_snapshot_data(self, series, panel):
+        """Build panel snapshot data from datapoints by target. Graph datapoints are reduced to panel maxDataPoints
+        or to max_datapoints of downsampling params, on time buckets shared by all series for bars and stacks"""
+        budget = None
+        if panel['type'] == 'graph':
+            budget = panel.get('maxDataPoints') or self.downsampling_params.get('max_datapoints')
+        if panel.get('bars') or panel.get('stack'):
+            reduced = Downsampler.downsample_aligned(series, budget)
+        else:
+            reduced = dict((target, Downsampler.downsample(datapoints, budget))
+                           for target, datapoints in series.iteritems())
+        return [{"datapoints": reduced[target], "target": target} for target in series]
+
+    def get_snapshot(self, key=snapshot_key):
+        """Insert data to dashboards and make snapshot request, under profiler if profile_path is set"""
         try:
-            overview_data = self.data_provider.get_overview_data(self.overview_queries, self.query_values_dict)
-            separate_requests_data = self.data_provider.get_requests_data(self.detailed_queries, self.query_values_dict)
-
-            self.insert_dataset(overview_data)
-            self.insert_separate_dashboards(separate_requests_data)
-            snapshot = requests.post('http://%s/api/snapshots' % self.connection_params['host'], json=self.dashboard_template, verify=False,
-                                     headers=
-                                     {
-                                         "Accept": "application/json",
-                                         "Content-type": "application/json",
-                                         "Authorization": key
-                                     }
-                                     )
-
-            return snapshot
+            return self.instrumentation.profile(self.create_snapshot, key)
         except Exception as e:
             print "Snapshot could not be created. Details: %s" % e.message
 
-    def get_dashboard_template(self, template_path):
-        """Load dashboard template from path and replace ids"""
-        with open(template_path) as data_file:
-            dashboard_template = json.load(data_file)
+    def create_snapshot(self, key=snapshot_key):
+        """Insert data to dashboards and make snapshot request, errors are raised to caller"""
+        self.data_provider.failed_queries = []
+        with self.instrumentation.phase('overview_queries'):
+            self.overview_data = self.data_provider.get_overview_data(self.overview_queries, self.query_values_dict)
+        with self.instrumentation.phase('requests_queries'):
+            self.separate_requests_data = self.data_provider.get_requests_data(self.detailed_queries,
+                                                                               self.query_values_dict)
+        self.update_last_seen()
+        snapshot = self.upload_snapshot(key)
+        self.report_instrumentation()
+        return snapshot
+
+    def refresh_snapshot(self, to_time, key=snapshot_key):
+        """Extend snapshot of test in progress up to to_time. Only points newer than the last seen bucket of
+        each series are queried and singlestat aggregates are recomputed, then previous snapshot is replaced.
+        When all requests are selected, request names are discovered again and new ones are queried over whole
+        time range"""
+        if self.overview_data is None:
+            self.set_time_range(to_time)
+            return self.create_snapshot(key)
+
+        self.instrumentation.reset()
+        previous_snapshot = self.snapshot
+        tail_start = self.get_tail_start()
+        self.set_time_range(to_time)
+        new_request_names = self.rediscover_request_names()
+        known_request_names = [name for name in self.data_provider.arguments_dict['request_names']
+                               if name not in new_request_names]
+        tail_values_dict = dict(self.query_values_dict, time_filter=self.tail_time_filter.format(tail_start, to_time))
+        singlestat_queries = dict((name, queries) for name, queries in self.overview_queries.iteritems()
+                                  if self.is_singlestat(queries))
+        series_queries = dict((name, queries) for name, queries in self.overview_queries.iteritems()
+                              if name not in singlestat_queries)
+
+        self.data_provider.failed_queries = []
+        with self.instrumentation.phase('overview_queries'):
+            overview_tail = self.data_provider.get_overview_data(series_queries, tail_values_dict)
+            singlestat_data = self.data_provider.get_overview_data(singlestat_queries, self.query_values_dict)
+        with self.instrumentation.phase('requests_queries'):
+            requests_tail = self.data_provider.get_requests_data(self.detailed_queries, tail_values_dict,
+                                                                 known_request_names)
+            new_requests_data = self.data_provider.get_requests_data(self.detailed_queries, self.query_values_dict,
+                                                                     new_request_names)
+        with self.instrumentation.phase('merge_tail'):
+            self.merge_tail(self.overview_data, overview_tail, tail_start)
+            self.merge_tail(self.separate_requests_data, requests_tail, tail_start)
+            self.overview_data.update(singlestat_data)
+            self.separate_requests_data.update(new_requests_data)
+        self.update_last_seen()
+
+        snapshot = self.upload_snapshot(key)
+        if snapshot.ok and previous_snapshot is not None:
+            self.delete_snapshot(previous_snapshot)
+        self.report_instrumentation()
+        return snapshot
+
+    def upload_snapshot(self, key):
+        """Insert collected data to dashboards and make snapshot request"""
+        self.report_failed_queries()
+        self.report_cache_stats()
+
+        with self.instrumentation.phase('insert_dataset'):
+            self.insert_dataset(self.overview_data)
+        del self.dashboard_template['dashboard']['rows'][self.detailed_rows_start:]
+        with self.instrumentation.phase('insert_separate_dashboards'):
+            self.insert_separate_dashboards(self.separate_requests_data)
+        body = SnapshotBody(self.dashboard_template, self.upload_params.get('chunk_size', 64 * 1024),
+                            self.upload_params.get('gzip', False))
+        headers = {
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Authorization": key
+        }
+        if body.compress:
+            headers["Content-Encoding"] = "gzip"
+        with self.instrumentation.phase('upload'):
+            snapshot = self.transport.post(self.grafana_url + '/api/snapshots',
+                                           lambda: iter(body) if self.upload_params.get('stream') else body.read(),
+                                           verify=False, headers=headers)
+        self.upload_stats = {'serialized_bytes': body.serialized_bytes, 'sent_bytes': body.sent_bytes}
+        self.instrumentation.record_payload(self.upload_stats)
+        print "Snapshot payload: %(serialized_bytes)d bytes serialized, %(sent_bytes)d bytes sent" % self.upload_stats
+
+        self.snapshot = snapshot
+        return snapshot
+
+    def delete_snapshot(self, snapshot):
+        """Delete snapshot by delete url from snapshot response"""
+        try:
+            self.transport.get(snapshot.json()['deleteUrl'], verify=False).raise_for_status()
+        except Exception as e:
+            print "Previous snapshot could not be deleted. Details: %s" % e
+
+    def set_time_range(self, to_time):
+        """Move end of test time range to to_time"""
+        arguments_dict = self.data_provider.arguments_dict
+        arguments_dict['to_time'] = to_time
+        arguments_dict['time_filter'] = self.time_filter.format(arguments_dict['from_time'], to_time)
+        self.query_values_dict['to_time'] = to_time
+        self.query_values_dict['time_filter'] = arguments_dict['time_filter']
+        self.insert_timerange(self.dashboard_template, arguments_dict['from_time'], to_time)
+
+    def rediscover_request_names(self):
+        """Discover request names over current time range again if all requests are selected, as requests can
+        get first traffic later in the test. Return names that were not known before"""
+        arguments_dict = self.data_provider.arguments_dict
+        if arguments_dict['request_name'] != "All":
+            return []
+        known_request_names = arguments_dict['request_names']
+        self.preprocessor.process_requests(arguments_dict)
+        new_request_names = [name for name in arguments_dict['request_names'] if name not in known_request_names]
+        arguments_dict['request_names'] = known_request_names + new_request_names
+        self.query_values_dict['request_names'] = arguments_dict['request_names']
+        return new_request_names
+
+    @staticmethod
+    def is_singlestat(queries):
+        """Check that all queries of dashboard aggregate whole time range into single value"""
+        return all(DataProvider.aggregate_pattern.match(query) and not DataProvider.group_by_time_pattern.search(query)
+                   for query in queries.itervalues())
+
+    def update_last_seen(self):
+        """Remember timestamp of last point of each collected series"""
+        self.last_seen = {}
+        for path, datapoints in self.iter_series((), {'overview': self.overview_data,
+                                                      'requests': self.separate_requests_data}):
+            if len(datapoints):
+                self.last_seen[path] = datapoints.times[-1] if isinstance(datapoints, Datapoints) \
+                    else datapoints[-1][1]
+
+    def get_tail_start(self):
+        """Start of time range to query on refresh: bucket of the latest point seen so far, as that bucket
+        could be incomplete when it was queried. Series that stopped earlier have no newer points to query.
+        Start is aligned to least common multiple of GROUP BY steps, so no query gets a partial bucket"""
+        arguments_dict = self.data_provider.arguments_dict
+        if not self.last_seen:
+            return arguments_dict['from_time']
+        steps = [DataProvider.duration_to_ms(interval)
+                 for queries in self.overview_queries.values() + self.detailed_queries.values()
+                 for query in queries.itervalues()
+                 for interval in DataProvider.group_by_time_pattern.findall(query)
+                 if '%' not in interval] + [DataProvider.duration_to_ms(self.query_values_dict['interval'])]
+        step = reduce(lambda first, second: first * second // gcd(first, second), steps)
+        tail_start = min(max(self.last_seen.values()), arguments_dict['to_time'])
+        return max(tail_start // step * step, arguments_dict['from_time'])
+
+    @staticmethod
+    def iter_series(path, results):
+        """Generate (path, datapoints) for each series in nested results dict"""
+        for key, value in results.iteritems():
+            if isinstance(value, dict):
+                for item in SnapshotCreator.iter_series(path + (key,), value):
+                    yield item
+            else:
+                yield path + (key,), value
+
+    @staticmethod
+    def merge_tail(results, tail_results, tail_start):
+        """Replace points of series in nested results dict starting from tail_start with points of tail results"""
+        for key, tail in tail_results.iteritems():
+            if isinstance(tail, dict):
+                SnapshotCreator.merge_tail(results.setdefault(key, {}), tail, tail_start)
+                continue
+            datapoints = results.get(key, [])
+            if isinstance(datapoints, Datapoints):
+                keep = datapoints.times < tail_start
+                datapoints = Datapoints(datapoints.times[keep], datapoints.values[keep])
+            else:
+                datapoints = [point for point in datapoints if point[1] < tail_start]
+            if not len(tail):
+                results[key] = datapoints
+            elif not len(datapoints):
+                results[key] = tail
+            elif isinstance(datapoints, Datapoints) and isinstance(tail, Datapoints):
+                results[key] = Datapoints(np.concatenate((datapoints.times, tail.times)),
+                                          np.concatenate((datapoints.values, tail.values)))
+            else:
+                results[key] = list(datapoints) + list(tail)
+
+    def report_failed_queries(self):
+        """Print queries that failed, snapshot is still created with data of successful ones"""
+        if self.data_provider.failed_queries:
+            print "%d queries failed, corresponding panels will be empty:" % len(self.data_provider.failed_queries)
+            for query, error in self.data_provider.failed_queries:
+                print "    %s: %s" % (query, error)
+
+    def report_cache_stats(self):
+        """Print query cache and metadata index statistics"""
+        if self.data_provider.query_cache is not None:
+            print "Query cache: %(hits)d hits, %(misses)d misses, %(stores)d stored, %(evictions)d evicted, " \
+                  "%(size)d bytes" % self.data_provider.query_cache.get_stats()
+        print "Metadata index: %(hits)d hits, %(misses)d misses, %(entries)d entries" % \
+              self.data_provider.metadata_index.get_stats()
+
+    def report_instrumentation(self):
+        """Save instrumentation report of the last snapshot, failing to write it does not fail the snapshot"""
+        try:
+            return self.instrumentation.save(self.data_provider.client,
+                                             {'simulation': self.data_provider.arguments_dict['simulation']})
+        except Exception as e:
+            print "Instrumentation report could not be saved. Details: %s" % e
+
+    def get_dashboard_template(self, template_path, template=None):
+        """Load dashboard template from path, or copy already loaded one, and replace ids"""
+        if template is not None:
+            dashboard_template = copy.deepcopy(template)
+        else:
+            with open(template_path) as data_file:
+                dashboard_template = json.load(data_file)
         self.replace_ids(dashboard_template)
         return dashboard_template
 
@@ -387,6 +1561,102 @@ class SnapshotCreator:
             panel["aliasColors"][alias % self.query_values_dict] = colors
 
 
-creator = SnapshotCreator(connection_params, arguments_dict, overview_structure, separate_requests_dict)
+class BatchSnapshotCreator:
+    """Create snapshots for several argument sets in parallel, sharing loaded template, InfluxDB client,
+    query cache and metadata index between them"""
+
+    def __init__(self, connection_params, overview_structure, separate_requests_structure, max_parallel=4,
+                 template_path="template.json", execution_params=None, cache_params=None, transport_params=None,
+                 metadata_params=None, **creator_params):
+        self.connection_params = connection_params
+        self.overview_structure = overview_structure
+        self.separate_requests_structure = separate_requests_structure
+        self.max_parallel = max_parallel
+        with open(template_path) as data_file:
+            self.template = json.load(data_file)
+        self.transport = HttpTransport(**(transport_params or {}))
+        self.client = self.transport.create_influx_client(connection_params,
+                                                          (execution_params or {}).get('query_timeout'))
+        self.query_cache = QueryCache(cache_params['path'], cache_params['max_size']) if cache_params else None
+        self.metadata_index = MetadataIndex((metadata_params or {}).get('path'), (metadata_params or {}).get('ttl'))
+        self.creator_params = dict(creator_params, execution_params=execution_params, metadata_params=metadata_params)
+
+    @staticmethod
+    def load_manifest(manifest_path):
+        """Load list of jobs from JSON manifest. Manifest is either list of arguments dicts or dict with
+        "jobs" list and "defaults" applied to every job"""
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file, object_hook=BatchSnapshotCreator.to_str)
+        if isinstance(manifest, list):
+            return manifest
+        return [dict(manifest.get('defaults', {}), **job) for job in manifest['jobs']]
+
+    @staticmethod
+    def to_str(item):
+        """Convert unicode strings of loaded JSON to str, as arguments processing expects"""
+        if isinstance(item, unicode):
+            return item.encode('utf-8')
+        if isinstance(item, list):
+            return [BatchSnapshotCreator.to_str(element) for element in item]
+        if isinstance(item, dict):
+            return dict((BatchSnapshotCreator.to_str(key), BatchSnapshotCreator.to_str(value))
+                        for key, value in item.iteritems())
+        return item
+
+    def run(self, jobs, key=snapshot_key):
+        """Create snapshot for each of arguments dicts in jobs, return summary with snapshot urls, timings
+        and failures in order of jobs"""
+        started = time()
+        pool = ThreadPool(max(1, min(self.max_parallel, len(jobs))))
+        try:
+            results = pool.map(lambda job: self.run_job(job, key), jobs)
+        finally:
+            pool.terminate()
+        return {
+            'snapshots': results,
+            'succeeded': len([result for result in results if result['error'] is None]),
+            'failed': len([result for result in results if result['error'] is not None]),
+            'duration': time() - started
+        }
+
+    def run_job(self, job, key):
+        """Create snapshot for single arguments dict"""
+        arguments = copy.deepcopy(job)
+        result = {'name': arguments.pop('name', None), 'url': None, 'error': None}
+        started = time()
+        try:
+            creator = SnapshotCreator(self.connection_params, arguments, self.overview_structure,
+                                      self.separate_requests_structure, template=self.template, client=self.client,
+                                      query_cache=self.query_cache, metadata_index=self.metadata_index,
+                                      transport=self.transport, **self.creator_params)
+            snapshot = creator.create_snapshot(key)
+            snapshot.raise_for_status()
+            result['url'] = snapshot.json().get('url')
+            result['failed_queries'] = len(creator.data_provider.failed_queries)
+            result['instrumentation'] = creator.instrumentation.report()['summary']
+        except Exception as e:
+            result['error'] = str(e)
+        result['duration'] = time() - started
+        return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        batch_creator = BatchSnapshotCreator(connection_params, overview_structure, separate_requests_dict,
+                                             batch_params['max_parallel_snapshots'],
+                                             execution_params=execution_params, cache_params=cache_params,
+                                             transport_params=transport_params, metadata_params=metadata_params,
+                                             distribution_structure=distribution_structure,
+                                             active_requests_query=active_requests_query,
+                                             upload_params=upload_params, downsampling_params=downsampling_params,
+                                             instrumentation_params=instrumentation_params)
+        print json.dumps(batch_creator.run(BatchSnapshotCreator.load_manifest(sys.argv[1])), indent=4)
+    else:
+        creator = SnapshotCreator(connection_params, arguments_dict, overview_structure, separate_requests_dict,
+                                  execution_params=execution_params, cache_params=cache_params,
+                                  distribution_structure=distribution_structure, upload_params=upload_params,
+                                  downsampling_params=downsampling_params, transport_params=transport_params,
+                                  instrumentation_params=instrumentation_params, metadata_params=metadata_params,
+                                  active_requests_query=active_requests_query)
 
-print creator.get_snapshot().json()
+        print creator.get_snapshot().json()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from snapshooter import DataProvider, Datapoints, Downsampler, HttpTransport, Instrumentation, QueryCache, \
+    SnapshotCreator, arguments_dict, overview_structure, separate_requests_dict
+
+connection_params = {'host': '127.0.0.1', 'port': 8086, 'login': '', 'password': '', 'database': 'perftest'}
+
+
+class ShardingTest(unittest.TestCase):
+    def setUp(self):
+        self.data_provider = DataProvider(connection_params, {}, {'shard_duration': '1h'}, client=object(),
+                                          transport=HttpTransport())
+
+    def test_step_longer_than_shard_without_boundary(self):
+        """Range shorter than shard rounded up to GROUP BY step is not sharded"""
+        query = 'SELECT SUM(count) FROM fix WHERE time > 0ms and time < %dms GROUP BY time(12h)' % (8 * 3600000)
+        self.data_provider.shard_duration = '6h'
+        self.assertIsNone(self.data_provider.plan_shards(query))
+
+    def test_shards_keep_lower_bound_operator(self):
+        """First shard keeps original lower bound, next shards start with >= at shard boundaries"""
+        for operator in ('>', '>='):
+            query = 'SELECT max("count") FROM fix WHERE time %s 1000ms and time < 7300000ms GROUP BY time(1m)' % \
+                    operator
+            shard_queries, combiner = self.data_provider.plan_shards(query)
+            self.assertIsNone(combiner)
+            self.assertEqual([shard_query.split('WHERE ')[1].split(' GROUP')[0] for shard_query in shard_queries],
+                             ['time %s 1000ms and time < 3600000ms' % operator,
+                              'time >= 3600000ms and time < 7200000ms',
+                              'time >= 7200000ms and time < 7300000ms'])
+
+    def test_merge_shards_concatenates_series(self):
+        """Points of shards are concatenated in time order without repeating boundary points"""
+        shard_results = [
+            {'series': [{'name': 'fix', 'columns': ['time', 'max'], 'values': [[0, 1], [3540000, 2]]}]},
+            {'series': [{'name': 'fix', 'columns': ['time', 'max'], 'values': [[3540000, 2], [3600000, 3]]}]}
+        ]
+        merged = DataProvider.merge_shards(shard_results, None)
+        self.assertEqual(merged['series'][0]['values'], [[0, 1], [3540000, 2], [3600000, 3]])
+
+    def test_merge_shards_combines_aggregates(self):
+        """Aggregated rows of shards are combined ignoring nulls"""
+        shard_results = [
+            {'series': [{'name': 'fix', 'columns': ['time', 'sum'], 'values': [[0, 5]]}]},
+            {'series': [{'name': 'fix', 'columns': ['time', 'sum'], 'values': [[3600000, None]]}]},
+            {'series': [{'name': 'fix', 'columns': ['time', 'sum'], 'values': [[7200000, 7]]}]}
+        ]
+        merged = DataProvider.merge_shards(shard_results, sum)
+        self.assertEqual(merged['series'][0]['values'], [[0, 12]])
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.query_cache = QueryCache(self.path, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_non_ascii_queries(self):
+        """UTF-8 encoded str and unicode queries are stored under the same entry"""
+        query = 'SELECT max("count") FROM fix WHERE "env" = \'caf\xc3\xa9\''
+        self.query_cache.put(query, 'perftest', {'series': []})
+        self.assertEqual(self.query_cache.get(query, 'perftest'), {'series': []})
+        self.assertEqual(self.query_cache.get(query.decode('utf-8'), 'perftest'), {'series': []})
+
+    def test_overwrite_keeps_size(self):
+        """Storing entry again replaces its size instead of adding to it"""
+        self.query_cache.put('SELECT 1', 'perftest', {'series': []})
+        size = self.query_cache.size
+        self.query_cache.put('SELECT 1', 'perftest', {'series': []})
+        self.assertEqual(self.query_cache.size, size)
+        self.assertEqual(self.query_cache.size, sum(entry_size for _, _, entry_size in
+                                                    self.query_cache.get_entries()))
+
+
+class DownsamplerTest(unittest.TestCase):
+    def test_downsample_aligned_shares_buckets(self):
+        """Series of stacked panel are reduced onto the same time buckets keeping bucket maximum"""
+        series = {
+            'ok': [[float(index % 7), index * 60000] for index in range(100)],
+            'ko': [[None if index % 3 else float(index), index * 60000] for index in range(100)]
+        }
+        reduced = Downsampler.downsample_aligned(series, 10)
+        self.assertEqual([point[1] for point in reduced['ok']], [point[1] for point in reduced['ko']])
+        self.assertLessEqual(len(reduced['ok']), 10)
+        self.assertEqual(reduced['ok'][0], [6.0, 0])
+        self.assertEqual(reduced['ko'][0], [9.0, 0])
+
+
+class InstrumentationTest(unittest.TestCase):
+    def test_latency_fields_are_float_when_all_cached(self):
+        """Latency fields keep float type when every query came from cache, so InfluxDB field types do not conflict"""
+        instrumentation = Instrumentation(measurement='snapshooter')
+        instrumentation.record_query('SELECT 1', 0.001, {'series': []}, 0, cached=True)
+        summary = instrumentation.report()['summary']
+        self.assertIsInstance(summary['query_latency'], float)
+        self.assertIsInstance(summary['max_query_latency'], float)
+
+
+class RefreshTest(unittest.TestCase):
+    hour = 60 * 60 * 1000
+
+    def create(self, interval):
+        """Snapshot creator for test with single request, no queries are made while creating it"""
+        arguments = dict(arguments_dict, interval=interval, from_time=0, to_time=3 * self.hour,
+                         request_name=['request'], test_type=['fix'])
+        return SnapshotCreator(connection_params, arguments, overview_structure, separate_requests_dict,
+                               client=object(), transport=HttpTransport())
+
+    def test_tail_start_aligned_to_all_steps(self):
+        """Tail start is multiple of both the interval and 1m steps when interval does not divide 1m"""
+        for interval, common_step in (('10s', 60000), ('45s', 180000), ('7s', 420000), ('90s', 180000)):
+            creator = self.create(interval)
+            creator.last_seen = {('overview', 'series'): 2 * self.hour + 100000, ('requests', 'series'): 1000}
+            tail_start = creator.get_tail_start()
+            self.assertEqual(tail_start, (2 * self.hour + 100000) // common_step * common_step)
+            self.assertEqual(tail_start % DataProvider.duration_to_ms(interval), 0)
+            self.assertEqual(tail_start % 60000, 0)
+
+    def test_merge_tail_without_duplicate_buckets(self):
+        """Series refreshed from tail start equal series queried over whole range, for 45s and 1m steps"""
+        creator = self.create('45s')
+        for step in (45000, 60000):
+            full = [[float(point_time % 7), point_time] for point_time in range(0, 3 * self.hour, step)]
+            previous = [point for point in full if point[1] < 2 * self.hour]
+            creator.last_seen = {('series',): previous[-1][1]}
+            tail_start = creator.get_tail_start()
+            # GROUP BY time returns the bucket containing lower bound of time range, which may start before it
+            tail = [point for point in full if point[1] >= tail_start // step * step]
+
+            results = {'panel': {'series': [list(point) for point in previous]}}
+            SnapshotCreator.merge_tail(results, {'panel': {'series': tail}}, tail_start)
+            self.assertEqual(results['panel']['series'], full)
+
+            results = {'panel': {'series': Datapoints.from_rows([[time, value] for value, time in previous])}}
+            SnapshotCreator.merge_tail(results, {'panel': {'series': Datapoints.from_rows(
+                [[time, value] for value, time in tail])}}, tail_start)
+            self.assertTrue(np.array_equal(results['panel']['series'].times, [time for _, time in full]))
+
+
+if __name__ == "__main__":
+    unittest.main()